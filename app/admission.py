@@ -0,0 +1,248 @@
+import asyncio
+import math
+import os
+import re
+import time
+from collections import deque
+
+from dotenv import load_dotenv
+from starlette.responses import JSONResponse
+
+load_dotenv()
+
+
+class Shed(Exception):
+    """The request was turned away to protect the server"""
+
+
+class RouteClass:
+    """Adaptive concurrency limit and wait queue for a group of routes
+
+    The limit follows the gradient between the long-term and the recent
+    latency: while requests get slower than usual it shrinks, otherwise it
+    grows back towards max_limit. A higher priority lets the class keep
+    queueing when the total queue of all classes gets long, so low
+    priority classes are shed first.
+    """
+
+    def __init__(
+        self,
+        name,
+        priority,
+        min_limit=1,
+        max_limit=64,
+        max_queue=32,
+        queue_timeout=5.0,
+        tolerance=2.0,
+    ):
+        self.name = name
+        self.priority = int(
+            os.getenv(f"ADMISSION_{name.upper()}_PRIORITY", priority)
+        )
+        self.min_limit = min_limit
+        self.max_limit = int(
+            os.getenv(f"ADMISSION_{name.upper()}_LIMIT", max_limit)
+        )
+        self.max_queue = int(
+            os.getenv(f"ADMISSION_{name.upper()}_QUEUE", max_queue)
+        )
+        self.queue_timeout = queue_timeout
+        self.tolerance = tolerance
+        self.limit = float(self.max_limit)
+        self.in_flight = 0
+        self.waiters = deque()
+        self.short_latency = None
+        self.long_latency = None
+        self.admitted = 0
+        self.shed_queue_full = 0
+        self.shed_timeout = 0
+
+    def can_run(self):
+        return self.in_flight < max(int(self.limit), self.min_limit)
+
+    def record_latency(self, latency):
+        if self.long_latency is None:
+            self.short_latency = self.long_latency = latency
+            return
+        self.short_latency += 0.2 * (latency - self.short_latency)
+        self.long_latency += 0.01 * (latency - self.long_latency)
+        gradient = min(
+            1.0,
+            max(
+                0.5,
+                self.tolerance * self.long_latency / self.short_latency,
+            ),
+        )
+        new_limit = self.limit * gradient + math.sqrt(self.limit)
+        self.limit = min(
+            self.max_limit,
+            max(self.min_limit, 0.8 * self.limit + 0.2 * new_limit),
+        )
+
+    def retry_after(self):
+        """Seconds until the queue is likely to have drained"""
+        latency = self.short_latency or 1.0
+        waiting = len(self.waiters) + self.in_flight
+        return max(1, math.ceil(latency * waiting / max(self.limit, 1)))
+
+    def stats(self):
+        return {
+            "priority": self.priority,
+            "limit": round(self.limit, 2),
+            "max_queue": self.max_queue,
+            "in_flight": self.in_flight,
+            "queued": len(self.waiters),
+            "latency": self.short_latency,
+            "admitted": self.admitted,
+            "shed_queue_full": self.shed_queue_full,
+            "shed_timeout": self.shed_timeout,
+        }
+
+
+class AdmissionController:
+    """Route requests to their class and admit, queue or shed them
+
+    Rules are tried in order, a rule naming no class exempts the route.
+    """
+
+    def __init__(self, classes, rules, max_total_queue=64):
+        self.classes = {
+            route_class.name: route_class for route_class in classes
+        }
+        self.rules = [
+            (methods, re.compile(pattern), name)
+            for methods, pattern, name in rules
+        ]
+        self.max_total_queue = int(
+            os.getenv("ADMISSION_MAX_TOTAL_QUEUE", max_total_queue)
+        )
+        self.levels = sorted({route_class.priority for route_class in classes})
+
+    def classify(self, method, path):
+        for methods, pattern, name in self.rules:
+            if method in methods and pattern.fullmatch(path):
+                return self.classes.get(name)
+
+    def total_queued(self):
+        return sum(
+            len(route_class.waiters) for route_class in self.classes.values()
+        )
+
+    def queue_allowed(self, route_class):
+        if len(route_class.waiters) >= route_class.max_queue:
+            return False
+        # the lowest priority may fill 1/n of the shared queue, the highest
+        # all of it
+        share = (self.levels.index(route_class.priority) + 1) / len(
+            self.levels
+        )
+        return self.total_queued() < self.max_total_queue * share
+
+    async def acquire(self, route_class):
+        if route_class.can_run() and not route_class.waiters:
+            route_class.in_flight += 1
+            route_class.admitted += 1
+            return
+        if not self.queue_allowed(route_class):
+            route_class.shed_queue_full += 1
+            raise Shed()
+        waiter = asyncio.get_running_loop().create_future()
+        route_class.waiters.append(waiter)
+        try:
+            await asyncio.wait_for(waiter, route_class.queue_timeout)
+        except asyncio.TimeoutError:
+            route_class.shed_timeout += 1
+            raise Shed()
+        except BaseException:
+            # the client went away after being granted a slot
+            if waiter.done() and not waiter.cancelled():
+                self.release(route_class, None)
+            raise
+        finally:
+            if waiter in route_class.waiters:
+                route_class.waiters.remove(waiter)
+        route_class.admitted += 1
+
+    def release(self, route_class, latency):
+        route_class.in_flight -= 1
+        if latency is not None:
+            route_class.record_latency(latency)
+        while route_class.waiters and route_class.can_run():
+            waiter = route_class.waiters.popleft()
+            if not waiter.done():
+                route_class.in_flight += 1
+                waiter.set_result(None)
+
+    def stats(self):
+        return {
+            name: route_class.stats()
+            for name, route_class in self.classes.items()
+        }
+
+
+def controller_from_env():
+    """Logins and signups are shed first, catalog reads last"""
+    return AdmissionController(
+        classes=[
+            RouteClass("auth", priority=0, max_limit=8, max_queue=16),
+            RouteClass("write", priority=1, max_limit=16, max_queue=32),
+            RouteClass("read", priority=2, max_limit=64, max_queue=128),
+        ],
+        rules=[
+            # the counters must stay readable under overload
+            ({"GET"}, r"/api/v1/admission", None),
+            ({"POST"}, r"/api/v1/students/(login|signup)", "auth"),
+            ({"GET"}, r"/api/v1/.*", "read"),
+            ({"POST", "PUT", "DELETE"}, r"/api/v1/.*", "write"),
+        ],
+        max_total_queue=128,
+    )
+
+
+class AdmissionMiddleware:
+    """Answer 503 with Retry-After instead of letting requests pile up"""
+
+    def __init__(self, app, controller):
+        self.app = app
+        self.controller = controller
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        route_class = self.controller.classify(scope["method"], scope["path"])
+        if route_class is None:
+            await self.app(scope, receive, send)
+            return
+        try:
+            await self.controller.acquire(route_class)
+        except Shed:
+            response = JSONResponse(
+                status_code=503,
+                content="Server is overloaded, please retry later",
+                headers={"Retry-After": str(route_class.retry_after())},
+            )
+            await response(scope, receive, send)
+            return
+        started = time.perf_counter()
+        released = False
+
+        def release(latency):
+            nonlocal released
+            if not released:
+                released = True
+                self.controller.release(route_class, latency)
+
+        async def release_on_last_body(message):
+            await send(message)
+            # background tasks run after the response inside the same call,
+            # they must neither hold the slot nor count as latency
+            if message["type"] == "http.response.body" and not message.get(
+                "more_body", False
+            ):
+                release(time.perf_counter() - started)
+
+        try:
+            await self.app(scope, receive, release_on_last_body)
+        finally:
+            release(None)
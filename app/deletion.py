@@ -0,0 +1,194 @@
+import os
+from datetime import datetime
+from datetime import timedelta
+
+from dotenv import load_dotenv
+from sqlalchemy import and_
+from sqlalchemy import or_
+
+from app.db import SessionLocal
+from app.models import Course
+from app.models import CourseSession
+from app.models import CourseSignUp
+from app.models import DeletionJob
+from app.models import Student
+from app.schedule import bump_schedule_versions
+
+load_dotenv()
+
+
+PURGE_BATCH_SIZE = int(os.getenv("PURGE_BATCH_SIZE", "500"))
+DELETION_JOB_TIMEOUT = int(os.getenv("DELETION_JOB_TIMEOUT", "60"))
+
+ENTITIES = {
+    "course": (Course, Course.course_id, CourseSignUp.course_id),
+    "student": (Student, Student.student_id, CourseSignUp.student_id),
+}
+
+
+def schedule_deletion(session, row, entity):
+    """Hide the row from reads and register a job that purges it"""
+    model, id_column, _ = ENTITIES[entity]
+    row.deleted_at = datetime.utcnow()
+    job = DeletionJob(
+        entity=entity,
+        entity_id=getattr(row, id_column.key),
+        status="pending",
+        purged_signups=0,
+        created_at=datetime.utcnow(),
+    )
+    if entity == "course":
+        bump_schedule_versions(
+            session,
+            session.query(CourseSignUp.student_id).filter(
+                CourseSignUp.course_id == job.entity_id
+            ),
+        )
+    session.add(job)
+    session.commit()
+    return job
+
+
+def claim(session, job_id):
+    """Take the job over, return the heartbeat proving ownership or None
+
+    Pending and failed jobs can be claimed, running ones only when their
+    worker stopped updating the heartbeat, so a job never runs twice.
+    """
+    now = datetime.utcnow()
+    stale = now - timedelta(seconds=DELETION_JOB_TIMEOUT)
+    claimed = (
+        session.query(DeletionJob)
+        .filter(
+            DeletionJob.job_id == job_id,
+            or_(
+                DeletionJob.status.in_(["pending", "failed"]),
+                and_(
+                    DeletionJob.status == "running",
+                    or_(
+                        DeletionJob.heartbeat_at.is_(None),
+                        DeletionJob.heartbeat_at < stale,
+                    ),
+                ),
+            ),
+        )
+        .update(
+            {"status": "running", "heartbeat_at": now, "error": None},
+            synchronize_session=False,
+        )
+    )
+    session.commit()
+    return now if claimed else None
+
+
+def purge(job_id):
+    """Remove the enrollments of a soft-deleted row in small transactions
+
+    Every batch is committed on its own, so locks on course_sign_up are
+    held only for a short time and enrollment traffic keeps going. The row
+    itself is deleted once nothing references it anymore.
+    """
+    session = SessionLocal()
+    try:
+        heartbeat = claim(session, job_id)
+        if heartbeat is None:
+            return
+        job = session.query(DeletionJob).get(job_id)
+        model, id_column, signup_column = ENTITIES[job.entity]
+
+        while True:
+            batch = [
+                signup_id
+                for (signup_id,) in session.query(
+                    CourseSignUp.course_sing_up_id
+                )
+                .filter(signup_column == job.entity_id)
+                .limit(PURGE_BATCH_SIZE)
+            ]
+            if not batch:
+                break
+            session.query(CourseSignUp).filter(
+                CourseSignUp.course_sing_up_id.in_(batch)
+            ).delete(synchronize_session=False)
+            heartbeat = _beat(session, job_id, heartbeat, len(batch))
+            if heartbeat is None:
+                return
+
+        # signups that slipped past the deleted_at check after the last
+        # batch go in the same transaction as the row, so the row delete
+        # cannot hit the foreign key
+        remaining = (
+            session.query(CourseSignUp)
+            .filter(signup_column == job.entity_id)
+            .delete(synchronize_session=False)
+        )
+        if job.entity == "course":
+            session.query(CourseSession).filter(
+                CourseSession.course_id == job.entity_id
+            ).delete(synchronize_session=False)
+        session.query(model).filter(id_column == job.entity_id).delete(
+            synchronize_session=False
+        )
+        if _beat(session, job_id, heartbeat, remaining, "done") is None:
+            return
+    except Exception as exc:
+        session.rollback()
+        session.query(DeletionJob).filter(
+            DeletionJob.job_id == job_id, DeletionJob.status == "running"
+        ).update(
+            {
+                "status": "failed",
+                "error": str(exc),
+                "finished_at": datetime.utcnow(),
+            },
+            synchronize_session=False,
+        )
+        session.commit()
+        raise
+    finally:
+        session.close()
+
+
+def _beat(session, job_id, heartbeat, purged, status="running"):
+    """Commit a batch if the job is still ours, return the new heartbeat"""
+    now = datetime.utcnow()
+    values = {
+        "purged_signups": DeletionJob.purged_signups + purged,
+        "heartbeat_at": now,
+        "status": status,
+    }
+    if status == "done":
+        values["finished_at"] = now
+    owned = (
+        session.query(DeletionJob)
+        .filter(
+            DeletionJob.job_id == job_id,
+            DeletionJob.heartbeat_at == heartbeat,
+        )
+        .update(values, synchronize_session=False)
+    )
+    if not owned:
+        # another worker took the job over, drop this batch
+        session.rollback()
+        return None
+    session.commit()
+    return now
+
+
+def resume_unfinished():
+    """Run the jobs that were interrupted or failed"""
+    session = SessionLocal()
+    try:
+        job_ids = [
+            job_id
+            for (job_id,) in session.query(DeletionJob.job_id).filter(
+                DeletionJob.status.in_(["pending", "running", "failed"])
+            )
+        ]
+    finally:
+        session.close()
+    for job_id in job_ids:
+        try:
+            purge(job_id)
+        except Exception:
+            continue
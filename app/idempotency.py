@@ -0,0 +1,354 @@
+import asyncio
+import hashlib
+import json
+import os
+import sqlite3
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Optional
+
+from dotenv import load_dotenv
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import JSONResponse
+
+load_dotenv()
+
+
+IDEMPOTENCY_HEADER = "idempotency-key"
+REPLAYED_HEADER = "idempotent-replayed"
+
+
+class IdempotencyConflict(Exception):
+    """The key was already used for a different request"""
+
+
+@dataclass
+class StoredResponse:
+    fingerprint: str
+    status: int
+    headers: list
+    body: bytes
+    created_at: float
+
+
+class MemoryIdempotencyStore:
+    """Bounded FIFO store with TTL eviction, local to one worker"""
+
+    def __init__(self, ttl=86400, max_entries=10000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._in_flight = {}
+
+    def _evict(self):
+        deadline = time.time() - self.ttl
+        while self._entries:
+            key, entry = next(iter(self._entries.items()))
+            if entry.created_at >= deadline:
+                break
+            del self._entries[key]
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    async def begin(self, key, fingerprint) -> Optional[StoredResponse]:
+        """Return the stored response, or None if the caller must run it"""
+        while True:
+            self._evict()
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry.fingerprint != fingerprint:
+                    raise IdempotencyConflict(key)
+                return entry
+            in_flight = self._in_flight.get(key)
+            if in_flight is None:
+                self._in_flight[key] = (fingerprint, asyncio.Event())
+                return None
+            if in_flight[0] != fingerprint:
+                raise IdempotencyConflict(key)
+            await in_flight[1].wait()
+
+    async def finish(self, key, response: StoredResponse):
+        self._entries.pop(key, None)
+        self._entries[key] = response
+        self._evict()
+        self._release(key)
+
+    async def abandon(self, key):
+        self._release(key)
+
+    def _release(self, key):
+        in_flight = self._in_flight.pop(key, None)
+        if in_flight is not None:
+            in_flight[1].set()
+
+
+class SQLiteIdempotencyStore:
+    """Store shared by several workers on one host through an SQLite file
+
+    Queries wait on the file lock and on fsync, so they run in the
+    threadpool instead of on the event loop.
+    """
+
+    def __init__(
+        self,
+        path="idempotency.db",
+        ttl=86400,
+        max_entries=10000,
+        lock_timeout=60,
+        poll_interval=0.05,
+    ):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.lock_timeout = lock_timeout
+        self.poll_interval = poll_interval
+        with self._connect() as conn:
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS idempotency_keys (
+                    key TEXT PRIMARY KEY,
+                    fingerprint TEXT NOT NULL,
+                    status INTEGER,
+                    headers TEXT,
+                    body BLOB,
+                    created_at REAL NOT NULL
+                )
+                """
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS ix_idempotency_keys_created_at "
+                "ON idempotency_keys (created_at)"
+            )
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def _evict(self, conn):
+        conn.execute(
+            "DELETE FROM idempotency_keys "
+            "WHERE status IS NOT NULL AND created_at < ?",
+            (time.time() - self.ttl,),
+        )
+        conn.execute(
+            "DELETE FROM idempotency_keys WHERE key IN ("
+            "SELECT key FROM idempotency_keys WHERE status IS NOT NULL "
+            "ORDER BY created_at DESC LIMIT -1 OFFSET ?)",
+            (self.max_entries,),
+        )
+
+    def _claim(self, key, fingerprint):
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                "DELETE FROM idempotency_keys "
+                "WHERE key = ? AND status IS NULL AND created_at < ?",
+                (key, now - self.lock_timeout),
+            )
+            claimed = conn.execute(
+                "INSERT OR IGNORE INTO idempotency_keys "
+                "(key, fingerprint, created_at) VALUES (?, ?, ?)",
+                (key, fingerprint, now),
+            ).rowcount
+            if claimed:
+                return True, None
+            row = conn.execute(
+                "SELECT fingerprint, status, headers, body, created_at "
+                "FROM idempotency_keys WHERE key = ?",
+                (key,),
+            ).fetchone()
+        return False, row
+
+    async def begin(self, key, fingerprint) -> Optional[StoredResponse]:
+        """Return the stored response, or None if the caller must run it"""
+        while True:
+            claimed, row = await run_in_threadpool(
+                self._claim, key, fingerprint
+            )
+            if claimed:
+                return None
+            if row is None:
+                # the row expired between the insert and the select
+                await asyncio.sleep(self.poll_interval)
+                continue
+            if row[0] != fingerprint:
+                raise IdempotencyConflict(key)
+            if row[1] is not None:
+                return StoredResponse(
+                    fingerprint=row[0],
+                    status=row[1],
+                    headers=[
+                        [name.encode("latin-1"), value.encode("latin-1")]
+                        for name, value in json.loads(row[2])
+                    ],
+                    body=row[3],
+                    created_at=row[4],
+                )
+            await asyncio.sleep(self.poll_interval)
+
+    async def finish(self, key, response: StoredResponse):
+        await run_in_threadpool(self._finish, key, response)
+
+    def _finish(self, key, response):
+        headers = json.dumps(
+            [
+                [name.decode("latin-1"), value.decode("latin-1")]
+                for name, value in response.headers
+            ]
+        )
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE idempotency_keys "
+                "SET status = ?, headers = ?, body = ?, created_at = ? "
+                "WHERE key = ?",
+                (
+                    response.status,
+                    headers,
+                    response.body,
+                    response.created_at,
+                    key,
+                ),
+            )
+            self._evict(conn)
+
+    async def abandon(self, key):
+        await run_in_threadpool(self._abandon, key)
+
+    def _abandon(self, key):
+        with self._connect() as conn:
+            conn.execute(
+                "DELETE FROM idempotency_keys "
+                "WHERE key = ? AND status IS NULL",
+                (key,),
+            )
+
+
+def store_from_env():
+    """Build the store configured by the IDEMPOTENCY_* variables"""
+    ttl = int(os.getenv("IDEMPOTENCY_TTL", "86400"))
+    max_entries = int(os.getenv("IDEMPOTENCY_MAX_ENTRIES", "10000"))
+    if os.getenv("IDEMPOTENCY_BACKEND", "memory") == "sqlite":
+        return SQLiteIdempotencyStore(
+            path=os.getenv("IDEMPOTENCY_SQLITE_PATH", "idempotency.db"),
+            ttl=ttl,
+            max_entries=max_entries,
+        )
+    return MemoryIdempotencyStore(ttl=ttl, max_entries=max_entries)
+
+
+class IdempotencyMiddleware:
+    """Replay stored responses for POST requests with an Idempotency-Key
+
+    The first request with a key runs the handler, later ones with the same
+    key get its response back. Duplicates arriving while the first one is
+    still running wait for it. Server errors are not stored, so the client
+    can retry them.
+    """
+
+    def __init__(self, app, store, methods=("POST",), identify=None):
+        self.app = app
+        self.store = store
+        self.methods = methods
+        # maps the Authorization header to the caller, so a refreshed token
+        # still finds the responses stored under the old one
+        self.identify = identify or (lambda authorization: authorization)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] not in self.methods:
+            await self.app(scope, receive, send)
+            return
+        headers = dict(scope["headers"])
+        idempotency_key = headers.get(IDEMPOTENCY_HEADER.encode())
+        if not idempotency_key:
+            await self.app(scope, receive, send)
+            return
+
+        body = b""
+        more_body = True
+        while more_body:
+            message = await receive()
+            body += message.get("body", b"")
+            more_body = message.get("more_body", False)
+
+        # keys are scoped to the route and the caller
+        authorization = headers.get(b"authorization", b"")
+        subject = self.identify(authorization) if authorization else b""
+        key = hashlib.sha256(
+            b"\n".join(
+                [
+                    scope["method"].encode(),
+                    scope["path"].encode(),
+                    subject,
+                    idempotency_key,
+                ]
+            )
+        ).hexdigest()
+        fingerprint = hashlib.sha256(body).hexdigest()
+
+        try:
+            stored = await self.store.begin(key, fingerprint)
+        except IdempotencyConflict:
+            response = JSONResponse(
+                status_code=422,
+                content="Idempotency-Key was already used "
+                "for a different request",
+            )
+            await response(scope, receive, send)
+            return
+        if stored is not None:
+            await send(
+                {
+                    "type": "http.response.start",
+                    "status": stored.status,
+                    "headers": stored.headers
+                    + [[REPLAYED_HEADER.encode(), b"true"]],
+                }
+            )
+            await send({"type": "http.response.body", "body": stored.body})
+            return
+
+        body_sent = False
+
+        async def replay_receive():
+            nonlocal body_sent
+            if body_sent:
+                # later calls wait for the client to disconnect
+                return await receive()
+            body_sent = True
+            return {"type": "http.request", "body": body, "more_body": False}
+
+        captured = {"body": b""}
+
+        async def capture_send(message):
+            if message["type"] == "http.response.start":
+                captured["status"] = message["status"]
+                captured["headers"] = list(message.get("headers", []))
+            elif message["type"] == "http.response.body":
+                captured["body"] += message.get("body", b"")
+            await send(message)
+
+        try:
+            await self.app(scope, replay_receive, capture_send)
+        except BaseException:
+            await self.store.abandon(key)
+            raise
+        if captured.get("status", 500) >= 500:
+            await self.store.abandon(key)
+            return
+        await self.store.finish(
+            key,
+            StoredResponse(
+                fingerprint=fingerprint,
+                status=captured["status"],
+                headers=captured["headers"],
+                body=captured["body"],
+                created_at=time.time(),
+            ),
+        )
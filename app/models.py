@@ -1,7 +1,9 @@
 from sqlalchemy import Column
+from sqlalchemy import DateTime
 from sqlalchemy import ForeignKey
 from sqlalchemy import Integer
 from sqlalchemy import String
+from sqlalchemy import Time
 from sqlalchemy.orm import declarative_base
 from sqlalchemy.orm import relationship
 
@@ -22,6 +24,11 @@ class Student(base):
     fullname = Column(String)
     email = Column(String)
     password = Column(String)
+    deleted_at = Column(DateTime, nullable=True)
+    # bumped by every change to the student's weekly schedule
+    schedule_version = Column(
+        Integer, nullable=False, default=0, server_default="0"
+    )
 
 
 class Course(base):
@@ -35,6 +42,7 @@ class Course(base):
     )
     title = Column(String)
     description = Column(String)
+    deleted_at = Column(DateTime, nullable=True)
 
 
 class CourseSignUp(base):
@@ -46,13 +54,49 @@ class CourseSignUp(base):
         unique=True,
         autoincrement=True,
     )
-    student_id = Column(Integer, ForeignKey("students.student_id"))
-    course_id = Column(Integer, ForeignKey("courses.course_id"))
+    student_id = Column(Integer, ForeignKey("students.student_id"), index=True)
+    course_id = Column(Integer, ForeignKey("courses.course_id"), index=True)
     student = relationship(
         "Student", backref="signup_student", lazy="subquery"
     )
     course = relationship("Course", backref="signup_course", lazy="subquery")
 
 
+class CourseSession(base):
+    __tablename__ = "course_sessions"
+    session_id = Column(
+        Integer,
+        primary_key=True,
+        nullable=False,
+        unique=True,
+        autoincrement=True,
+    )
+    course_id = Column(
+        Integer, ForeignKey("courses.course_id"), nullable=False, index=True
+    )
+    weekday = Column(Integer, nullable=False)
+    start_time = Column(Time, nullable=False)
+    end_time = Column(Time, nullable=False)
+
+
+class DeletionJob(base):
+    __tablename__ = "deletion_jobs"
+    job_id = Column(
+        Integer,
+        primary_key=True,
+        nullable=False,
+        unique=True,
+        autoincrement=True,
+    )
+    entity = Column(String, nullable=False)
+    entity_id = Column(Integer, nullable=False)
+    status = Column(String, nullable=False, default="pending")
+    purged_signups = Column(Integer, nullable=False, default=0)
+    error = Column(String, nullable=True)
+    created_at = Column(DateTime, nullable=False)
+    finished_at = Column(DateTime, nullable=True)
+    heartbeat_at = Column(DateTime, nullable=True)
+
+
 def database_init():
     base.metadata.create_all(engine)
@@ -0,0 +1,234 @@
+import os
+import threading
+from collections import Counter
+from collections import defaultdict
+
+import numpy as np
+from dotenv import load_dotenv
+from scipy import sparse
+
+from app.db import SessionLocal
+from app.models import Course
+from app.models import CourseSignUp
+from app.models import Student
+
+load_dotenv()
+
+
+RELATED_TOP_K = int(os.getenv("RELATED_TOP_K", "10"))
+# ids are not committed in order, enrollments committed during a rebuild
+# are searched this far below the highest id of the snapshot
+REPLAY_ID_SLACK = int(os.getenv("RELATED_REPLAY_ID_SLACK", "10000"))
+
+
+class CoEnrollmentIndex:
+    """Top-K "students who took this course also took" lists per course
+
+    The co-occurrence counts are the sparse product A.T @ A of the
+    student-by-course enrollment matrix. New enrollments are added on top
+    of it as small per-course deltas, since counts only ever go up between
+    rebuilds. An enrollment is paired only with the student's enrollments
+    that are already counted, so each pair is counted exactly once,
+    whatever order the enrollments arrive in.
+    """
+
+    def __init__(self, top_k=RELATED_TOP_K):
+        self.top_k = top_k
+        self.built = False
+        self._lock = threading.Lock()
+        self._positions = {}
+        self._course_ids = np.empty(0, dtype=np.int64)
+        self._matrix = sparse.csr_matrix((0, 0), dtype=np.int64)
+        self._delta = defaultdict(Counter)
+        self._neighbors = {}
+        self._snapshot_ids = np.empty(0, dtype=np.int64)
+        self._applied = set()
+
+    def build(self, student_ids, course_ids, signup_ids=()):
+        """Replace the index with one built from enrollment pairs
+
+        signup_ids are the course_sing_up_id of the pairs, the other
+        enrollments are expected through add_enrollment.
+        """
+        student_ids = np.asarray(student_ids, dtype=np.int64)
+        course_ids = np.asarray(course_ids, dtype=np.int64)
+        unique_courses, columns = np.unique(course_ids, return_inverse=True)
+        unique_students, rows = np.unique(student_ids, return_inverse=True)
+
+        enrollments = sparse.csr_matrix(
+            (np.ones(len(rows), dtype=np.int64), (rows, columns)),
+            shape=(len(unique_students), len(unique_courses)),
+        )
+        # duplicated enrollments must not count twice
+        enrollments.sum_duplicates()
+        enrollments.data[:] = 1
+
+        matrix = (enrollments.T @ enrollments).tocsr()
+        matrix.setdiag(0)
+        matrix.eliminate_zeros()
+
+        neighbors = {}
+        for row, course_id in enumerate(unique_courses.tolist()):
+            start, end = matrix.indptr[row], matrix.indptr[row + 1]
+            neighbors[course_id] = self._top_k(
+                unique_courses[matrix.indices[start:end]],
+                matrix.data[start:end],
+            )
+
+        with self._lock:
+            self._positions = {
+                course_id: position
+                for position, course_id in enumerate(unique_courses.tolist())
+            }
+            self._course_ids = unique_courses
+            self._matrix = matrix
+            self._delta = defaultdict(Counter)
+            self._neighbors = neighbors
+            self._snapshot_ids = np.sort(
+                np.asarray(signup_ids, dtype=np.int64)
+            )
+            self._applied = set()
+            self.built = True
+
+    def rebuild(self):
+        """Build the index from the course_sign_up table
+
+        Enrollments committed while the snapshot is being processed are
+        replayed afterwards, so none of them is lost.
+        """
+        session = SessionLocal()
+        try:
+            snapshot = np.array(
+                self._active_signups(session).all(), dtype=np.int64
+            ).reshape(-1, 3)
+            self.build(snapshot[:, 1], snapshot[:, 2], snapshot[:, 0])
+
+            watermark = int(snapshot[:, 0].max()) if len(snapshot) else 0
+            for signup_id, student_id, course_id in (
+                self._active_signups(session)
+                .filter(
+                    CourseSignUp.course_sing_up_id
+                    > watermark - REPLAY_ID_SLACK
+                )
+                .order_by(CourseSignUp.course_sing_up_id)
+            ):
+                self.add_enrollment(
+                    signup_id,
+                    course_id,
+                    lambda: other_signups(session, student_id, signup_id),
+                )
+        finally:
+            session.close()
+
+    @staticmethod
+    def _active_signups(session):
+        return (
+            session.query(
+                CourseSignUp.course_sing_up_id,
+                CourseSignUp.student_id,
+                CourseSignUp.course_id,
+            )
+            .join(Course, Course.course_id == CourseSignUp.course_id)
+            .join(Student, Student.student_id == CourseSignUp.student_id)
+            .filter(Course.deleted_at.is_(None), Student.deleted_at.is_(None))
+        )
+
+    def add_enrollment(self, signup_id, course_id, other_signups):
+        """Account for an enrollment next to the student's other ones
+
+        other_signups returns (course_sing_up_id, course_id) of the
+        student's other active enrollments. It is called under the lock,
+        so of two concurrent enrollments the later one sees the earlier.
+        """
+        with self._lock:
+            # before the first build the replay in rebuild picks it up
+            if not self.built or self._counted(signup_id):
+                return
+            for other_signup_id, other_id in other_signups():
+                if other_id == course_id or not self._counted(other_signup_id):
+                    continue
+                self._delta[course_id][other_id] += 1
+                self._delta[other_id][course_id] += 1
+                self._bump(other_id, course_id)
+            self._applied.add(signup_id)
+            counts = self._row_counts(course_id)
+            self._neighbors[course_id] = self._top_k(
+                np.fromiter(counts.keys(), dtype=np.int64, count=len(counts)),
+                np.fromiter(
+                    counts.values(), dtype=np.int64, count=len(counts)
+                ),
+            )
+
+    def _counted(self, signup_id):
+        if signup_id in self._applied:
+            return True
+        position = np.searchsorted(self._snapshot_ids, signup_id)
+        return (
+            position < len(self._snapshot_ids)
+            and self._snapshot_ids[position] == signup_id
+        )
+
+    def __len__(self):
+        return len(self._neighbors)
+
+    def related(self, course_id):
+        """Return the ids of the most co-enrolled courses, best first"""
+        return [other_id for other_id, _ in self._neighbors.get(course_id, [])]
+
+    def _top_k(self, course_ids, counts):
+        if len(counts) > self.top_k:
+            # keep every tie of the K-th count, the sort below breaks them
+            threshold = -np.partition(-counts, self.top_k - 1)[self.top_k - 1]
+            best = counts >= threshold
+            course_ids, counts = course_ids[best], counts[best]
+        order = np.lexsort((course_ids, -counts))[: self.top_k]
+        return list(zip(course_ids[order].tolist(), counts[order].tolist()))
+
+    def _count(self, course_id, other_id):
+        count = self._delta[course_id][other_id]
+        row = self._positions.get(course_id)
+        column = self._positions.get(other_id)
+        if row is not None and column is not None:
+            count += int(self._matrix[row, column])
+        return count
+
+    def _row_counts(self, course_id):
+        counts = Counter(self._delta[course_id])
+        row = self._positions.get(course_id)
+        if row is not None:
+            start, end = self._matrix.indptr[row], self._matrix.indptr[row + 1]
+            for other_id, count in zip(
+                self._course_ids[self._matrix.indices[start:end]].tolist(),
+                self._matrix.data[start:end].tolist(),
+            ):
+                counts[other_id] += count
+        return counts
+
+    def _bump(self, course_id, other_id):
+        # only the count of other_id went up, so the list of course_id can
+        # be patched without looking at the whole row
+        neighbors = [
+            (neighbor_id, count)
+            for neighbor_id, count in self._neighbors.get(course_id, [])
+            if neighbor_id != other_id
+        ]
+        neighbors.append((other_id, self._count(course_id, other_id)))
+        neighbors.sort(key=lambda neighbor: (-neighbor[1], neighbor[0]))
+        self._neighbors[course_id] = neighbors[: self.top_k]
+
+
+def other_signups(session, student_id, signup_id):
+    """The student's other enrollments in courses that are not deleted"""
+    return (
+        session.query(CourseSignUp.course_sing_up_id, CourseSignUp.course_id)
+        .join(Course, Course.course_id == CourseSignUp.course_id)
+        .filter(
+            CourseSignUp.student_id == student_id,
+            CourseSignUp.course_sing_up_id != signup_id,
+            Course.deleted_at.is_(None),
+        )
+        .all()
+    )
+
+
+related_index = CoEnrollmentIndex()
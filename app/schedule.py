@@ -0,0 +1,201 @@
+import os
+import threading
+from bisect import bisect_left
+from bisect import bisect_right
+from collections import OrderedDict
+
+from dotenv import load_dotenv
+
+from app.models import Course
+from app.models import CourseSession
+from app.models import CourseSignUp
+from app.models import Student
+
+load_dotenv()
+
+
+SCHEDULE_CACHE_SIZE = int(os.getenv("SCHEDULE_CACHE_SIZE", "10000"))
+
+MINUTES_PER_DAY = 24 * 60
+
+
+def session_interval(weekday, start_time, end_time):
+    """Turn a weekly time slot into minutes since Monday 00:00"""
+    day = weekday * MINUTES_PER_DAY
+    return (
+        day + start_time.hour * 60 + start_time.minute,
+        day + end_time.hour * 60 + end_time.minute,
+    )
+
+
+def course_intervals(session, course_id):
+    """Return the weekly intervals of a course"""
+    return [
+        session_interval(weekday, start_time, end_time)
+        for weekday, start_time, end_time in session.query(
+            CourseSession.weekday,
+            CourseSession.start_time,
+            CourseSession.end_time,
+        ).filter(CourseSession.course_id == course_id)
+    ]
+
+
+class StudentSchedule:
+    """Weekly intervals of one student, sorted by start
+
+    max_ends[i] is the latest end among the first i + 1 intervals, so one
+    bisect tells whether anything starting before a new interval ends
+    overlaps it, even if older enrollments overlap each other.
+    """
+
+    def __init__(self):
+        self.starts = []
+        self.ends = []
+        self.course_ids = []
+        self.max_ends = []
+
+    def add(self, course_id, start, end):
+        position = bisect_right(self.starts, start)
+        self.starts.insert(position, start)
+        self.ends.insert(position, end)
+        self.course_ids.insert(position, course_id)
+        self.max_ends.insert(position, end)
+        for index in range(position, len(self.max_ends)):
+            if index:
+                self.max_ends[index] = max(
+                    self.ends[index], self.max_ends[index - 1]
+                )
+            else:
+                self.max_ends[index] = self.ends[index]
+
+    def find_conflict(self, start, end, ignore_course_id=None):
+        """Return the id of a course overlapping [start, end), if any"""
+        position = bisect_left(self.starts, end)
+        for index in range(position - 1, -1, -1):
+            if self.max_ends[index] <= start:
+                return None
+            if (
+                self.ends[index] > start
+                and self.course_ids[index] != ignore_course_id
+            ):
+                return self.course_ids[index]
+
+    def copy(self):
+        schedule = StudentSchedule()
+        schedule.starts = self.starts[:]
+        schedule.ends = self.ends[:]
+        schedule.course_ids = self.course_ids[:]
+        schedule.max_ends = self.max_ends[:]
+        return schedule
+
+
+def lock_students(session, student_ids):
+    """Lock the students' rows until commit, return their schedule versions
+
+    Every schedule change runs under these locks, so it is serialized in
+    the database across all workers.
+    """
+    return dict(
+        session.query(Student.student_id, Student.schedule_version)
+        .filter(
+            Student.student_id.in_(student_ids),
+            Student.deleted_at.is_(None),
+        )
+        .order_by(Student.student_id)
+        .with_for_update()
+        .all()
+    )
+
+
+def bump_schedule_versions(session, student_ids):
+    """Mark the students' schedules as changed in the current transaction"""
+    session.query(Student).filter(Student.student_id.in_(student_ids)).update(
+        {Student.schedule_version: Student.schedule_version + 1},
+        synchronize_session=False,
+    )
+
+
+class ScheduleIndex:
+    """Per-student schedules, loaded on demand and kept in an LRU cache
+
+    A cached schedule is used only while its version matches the
+    student's schedule_version column, which signups, session inserts and
+    course deletions bump. Callers read the column with lock_students, so
+    checking the cache costs no extra query.
+    """
+
+    def __init__(self, max_students=SCHEDULE_CACHE_SIZE):
+        self.max_students = max_students
+        self._lock = threading.Lock()
+        self._schedules = OrderedDict()
+
+    def _load(self, session, student_id):
+        intervals = [
+            (*session_interval(weekday, start_time, end_time), course_id)
+            for course_id, weekday, start_time, end_time in session.query(
+                CourseSession.course_id,
+                CourseSession.weekday,
+                CourseSession.start_time,
+                CourseSession.end_time,
+            )
+            .join(
+                CourseSignUp,
+                CourseSignUp.course_id == CourseSession.course_id,
+            )
+            .join(Course, Course.course_id == CourseSession.course_id)
+            .filter(
+                CourseSignUp.student_id == student_id,
+                Course.deleted_at.is_(None),
+            )
+        ]
+        # appending in start order keeps every add O(1)
+        schedule = StudentSchedule()
+        for start, end, course_id in sorted(intervals):
+            schedule.add(course_id, start, end)
+        return schedule
+
+    def _store(self, student_id, version, schedule):
+        with self._lock:
+            self._schedules[student_id] = (version, schedule)
+            self._schedules.move_to_end(student_id)
+            while len(self._schedules) > self.max_students:
+                self._schedules.popitem(last=False)
+
+    def _get(self, session, student_id, version):
+        with self._lock:
+            cached = self._schedules.get(student_id)
+            if cached is not None and cached[0] == version:
+                self._schedules.move_to_end(student_id)
+                return cached[1]
+        schedule = self._load(session, student_id)
+        self._store(student_id, version, schedule)
+        return schedule
+
+    def find_conflict(
+        self, session, student_id, version, intervals, ignore_course_id=None
+    ):
+        """Return the id of an enrolled course overlapping the intervals"""
+        schedule = self._get(session, student_id, version)
+        for start, end in intervals:
+            course_id = schedule.find_conflict(start, end, ignore_course_id)
+            if course_id is not None:
+                return course_id
+
+    def add(self, student_id, version, course_id, intervals):
+        """Record committed intervals that moved the student to version + 1
+
+        Only a schedule cached at exactly version is patched, the row lock
+        held until the commit guarantees nothing else happened in between.
+        """
+        with self._lock:
+            cached = self._schedules.get(student_id)
+        if cached is None or cached[0] != version:
+            return
+        # copy, a reader may still be looking at the old schedule
+        schedule = cached[1].copy()
+        for start, end in intervals:
+            schedule.add(course_id, start, end)
+        self._store(student_id, version + 1, schedule)
+
+
+schedule_index = ScheduleIndex()
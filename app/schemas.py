@@ -1,8 +1,11 @@
+from datetime import datetime
+from datetime import time
 from typing import Optional
 
 from pydantic import BaseModel
 from pydantic import EmailStr
 from pydantic import Field
+from pydantic import validator
 
 
 class CourseSchema(BaseModel):
@@ -89,3 +92,52 @@ class CourseSignUpSchema(BaseModel):
                 "student_id": "2",
             }
         }
+
+
+class CourseSessionSchema(BaseModel):
+    session_id: int = Field(default=None)
+    weekday: int = Field(..., ge=0, le=6)
+    start_time: time = Field(...)
+    end_time: time = Field(...)
+
+    @validator("end_time")
+    def end_after_start(cls, end_time, values):
+        if "start_time" in values and end_time <= values["start_time"]:
+            raise ValueError("end_time must be after start_time")
+        return end_time
+
+    class Config:
+        orm_mode = True
+        schema_extra = {
+            "example": {
+                "weekday": "0",
+                "start_time": "09:00",
+                "end_time": "10:30",
+            }
+        }
+
+
+class DeletionJobSchema(BaseModel):
+    job_id: int = Field(...)
+    entity: str = Field(...)
+    entity_id: int = Field(...)
+    status: str = Field(...)
+    purged_signups: int = Field(...)
+    error: Optional[str] = Field(default=None)
+    created_at: datetime = Field(...)
+    finished_at: Optional[datetime] = Field(default=None)
+
+    class Config:
+        orm_mode = True
+        schema_extra = {
+            "example": {
+                "job_id": "1",
+                "entity": "course",
+                "entity_id": "3",
+                "status": "running",
+                "purged_signups": "5000",
+                "error": None,
+                "created_at": "2022-08-20T12:00:00",
+                "finished_at": None,
+            }
+        }
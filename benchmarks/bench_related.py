@@ -0,0 +1,75 @@
+"""Benchmark the co-enrollment index on synthetic enrollments
+
+    python -m benchmarks.bench_related --enrollments 1000000
+"""
+import argparse
+import time
+
+import numpy as np
+
+from app.recommendations import CoEnrollmentIndex
+
+
+def synthetic_enrollments(enrollments, students, courses, seed=0):
+    """Enrollment pairs with a few popular courses, like a real catalog"""
+    rng = np.random.default_rng(seed)
+    popularity = 1 / np.arange(1, courses + 1) ** 0.8
+    popularity /= popularity.sum()
+    student_ids = rng.integers(1, students + 1, enrollments)
+    course_ids = rng.choice(
+        np.arange(1, courses + 1), enrollments, p=popularity
+    )
+    return student_ids, course_ids
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--enrollments", type=int, default=1_000_000)
+    parser.add_argument("--students", type=int, default=100_000)
+    parser.add_argument("--courses", type=int, default=5_000)
+    parser.add_argument("--signups", type=int, default=10_000)
+    args = parser.parse_args()
+
+    student_ids, course_ids = synthetic_enrollments(
+        args.enrollments, args.students, args.courses
+    )
+    index = CoEnrollmentIndex()
+
+    started = time.perf_counter()
+    signup_ids = np.arange(1, args.enrollments + 1)
+    index.build(student_ids, course_ids, signup_ids)
+    print(
+        f"build: {args.enrollments} enrollments, {len(index)} courses "
+        f"in {time.perf_counter() - started:.2f}s"
+    )
+
+    by_student = {}
+    for signup_id, student_id, course_id in zip(
+        signup_ids[:100_000].tolist(),
+        student_ids[:100_000].tolist(),
+        course_ids[:100_000].tolist(),
+    ):
+        by_student.setdefault(student_id, []).append((signup_id, course_id))
+    student_courses = list(by_student.values())
+    rng = np.random.default_rng(1)
+    started = time.perf_counter()
+    for signup in range(args.signups):
+        others = student_courses[signup % len(student_courses)]
+        index.add_enrollment(
+            args.enrollments + signup + 1,
+            int(rng.integers(1, args.courses + 1)),
+            lambda: others,
+        )
+    elapsed = time.perf_counter() - started
+    print(f"add_enrollment: {elapsed / args.signups * 1e6:.1f}us per signup")
+
+    lookups = rng.integers(1, args.courses + 1, 100_000).tolist()
+    started = time.perf_counter()
+    for course_id in lookups:
+        index.related(course_id)
+    elapsed = time.perf_counter() - started
+    print(f"related: {elapsed / len(lookups) * 1e6:.2f}us per lookup")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,187 @@
+"""Benchmark schedule conflict checks for students with many courses
+
+The checks run against an SQLite database, so the numbers include the row
+lock query that reads the schedule version and the reload of stale
+schedules, not only the in-memory bisect.
+
+    python -m benchmarks.bench_schedule --courses 300
+"""
+import argparse
+import random
+import time
+from datetime import time as clock
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from app.models import base
+from app.models import Course
+from app.models import CourseSession
+from app.models import CourseSignUp
+from app.models import Student
+from app.schedule import bump_schedule_versions
+from app.schedule import lock_students
+from app.schedule import MINUTES_PER_DAY
+from app.schedule import ScheduleIndex
+from app.schedule import session_interval
+
+STUDENT_ID = 1
+
+
+def slot_time(minutes):
+    return clock(minutes // 60, minutes % 60)
+
+
+def populate(session, courses, sessions_per_course, seed=0):
+    """A student taking every course, each slot's first half is taken
+
+    Returns one free slot per candidate course, in the second halves.
+    """
+    rng = random.Random(seed)
+    slots = courses * sessions_per_course * 2
+    length = 7 * MINUTES_PER_DAY // slots // 2 * 2
+    taken = courses * sessions_per_course
+    order = list(range(slots))
+    rng.shuffle(order)
+    session.add(Student(student_id=STUDENT_ID, fullname="f", email="e@x.io"))
+    for course_id in range(1, courses + 1):
+        session.add(Course(course_id=course_id, title=str(course_id)))
+        session.add(CourseSignUp(student_id=STUDENT_ID, course_id=course_id))
+    for index, slot in enumerate(order[:taken]):
+        start = slot * length
+        weekday, minute = divmod(start, MINUTES_PER_DAY)
+        session.add(
+            CourseSession(
+                course_id=index // sessions_per_course + 1,
+                weekday=weekday,
+                start_time=slot_time(minute),
+                end_time=slot_time(minute + length // 2),
+            )
+        )
+    session.commit()
+    free = []
+    for slot in order[taken:]:
+        weekday, minute = divmod(slot * length, MINUTES_PER_DAY)
+        free.append((weekday, minute, minute + length // 2))
+    return free, length
+
+
+def add_candidates(session, first_course_id, free):
+    for offset, (weekday, start, end) in enumerate(free):
+        course_id = first_course_id + offset
+        session.add(Course(course_id=course_id, title=str(course_id)))
+        session.add(
+            CourseSession(
+                course_id=course_id,
+                weekday=weekday,
+                start_time=slot_time(start),
+                end_time=slot_time(end),
+            )
+        )
+    session.commit()
+
+
+def sql_conflict(session, weekday, start, end):
+    """The check without an index: one overlap query per signup"""
+    return (
+        session.query(CourseSession.course_id)
+        .join(
+            CourseSignUp,
+            CourseSignUp.course_id == CourseSession.course_id,
+        )
+        .filter(
+            CourseSignUp.student_id == STUDENT_ID,
+            CourseSession.weekday == weekday,
+            CourseSession.start_time < end,
+            CourseSession.end_time > start,
+        )
+        .first()
+    )
+
+
+def timed(label, runs, function):
+    started = time.perf_counter()
+    for run in range(runs):
+        function(run)
+    elapsed = time.perf_counter() - started
+    print(f"{label}: {elapsed / runs * 1e3:.3f}ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--courses", type=int, default=300)
+    parser.add_argument("--sessions", type=int, default=3)
+    parser.add_argument("--checks", type=int, default=2000)
+    parser.add_argument("--signups", type=int, default=200)
+    args = parser.parse_args()
+
+    engine = create_engine("sqlite://")
+    base.metadata.create_all(engine)
+    session = sessionmaker(bind=engine)()
+    free, length = populate(session, args.courses, args.sessions)
+    free = free[: args.signups]
+    add_candidates(session, args.courses + 1, free)
+    print(
+        f"student with {args.courses} courses x {args.sessions} sessions, "
+        f"slots of {length // 2} minutes"
+    )
+
+    index = ScheduleIndex()
+    rng = random.Random(1)
+    checks = []
+    for _ in range(args.checks):
+        start = rng.randrange(7 * MINUTES_PER_DAY - 30)
+        checks.append((start, start + 30))
+
+    def cold(run):
+        version = lock_students(session, [STUDENT_ID])[STUDENT_ID]
+        ScheduleIndex().find_conflict(
+            session, STUDENT_ID, version, [checks[run]]
+        )
+        session.rollback()
+
+    def warm(run):
+        version = lock_students(session, [STUDENT_ID])[STUDENT_ID]
+        index.find_conflict(session, STUDENT_ID, version, [checks[run]])
+        session.rollback()
+
+    def sql(run):
+        start, end = checks[run]
+        weekday, minute = divmod(start, MINUTES_PER_DAY)
+        if minute + 30 >= MINUTES_PER_DAY:
+            minute = MINUTES_PER_DAY - 31
+        sql_conflict(
+            session, weekday, slot_time(minute), slot_time(minute + 30)
+        )
+        session.rollback()
+
+    timed("check, empty cache (lock + load)", min(args.checks, 50), cold)
+    timed("check, cached schedule (lock + bisect)", args.checks, warm)
+    timed("check, SQL overlap query", args.checks, sql)
+
+    def signup(run):
+        course_id = args.courses + 1 + run
+        weekday, start, end = free[run]
+        version = lock_students(session, [STUDENT_ID])[STUDENT_ID]
+        intervals = [
+            session_interval(weekday, slot_time(start), slot_time(end))
+        ]
+        if index.find_conflict(session, STUDENT_ID, version, intervals):
+            raise AssertionError("free slot reported as a conflict")
+        session.add(CourseSignUp(student_id=STUDENT_ID, course_id=course_id))
+        bump_schedule_versions(session, [STUDENT_ID])
+        session.commit()
+        index.add(STUDENT_ID, version, course_id, intervals)
+
+    timed("signup, lock + check + commit", len(free), signup)
+
+    print(
+        "signups stored:",
+        session.query(CourseSignUp)
+        .filter(CourseSignUp.course_id > args.courses)
+        .count(),
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,21 +1,44 @@
+import threading
+
 import uvicorn
+from fastapi import BackgroundTasks
 from fastapi import FastAPI
 from fastapi import HTTPException
+from fastapi import Response
 from fastapi import Security
 from fastapi import status
+from fastapi.concurrency import run_in_threadpool
 from fastapi.exceptions import RequestValidationError
 from fastapi.responses import JSONResponse
 from fastapi.security import HTTPAuthorizationCredentials
 from fastapi.security import HTTPBearer
 
+from app.admission import AdmissionMiddleware
+from app.admission import controller_from_env
 from app.db import db
+from app.deletion import purge
+from app.deletion import resume_unfinished
+from app.deletion import schedule_deletion
+from app.idempotency import IdempotencyMiddleware
+from app.idempotency import store_from_env
 from app.jwt_auth import Auth
 from app.models import Course
+from app.models import CourseSession
 from app.models import CourseSignUp
+from app.models import DeletionJob
 from app.models import Student
+from app.recommendations import other_signups
+from app.recommendations import related_index
+from app.schedule import bump_schedule_versions
+from app.schedule import course_intervals
+from app.schedule import lock_students
+from app.schedule import schedule_index
+from app.schedule import session_interval
 from app.schemas import CourseSchema
+from app.schemas import CourseSessionSchema
 from app.schemas import CourseSignUpSchema
 from app.schemas import CourseUpdateSchema
+from app.schemas import DeletionJobSchema
 from app.schemas import StudentListSchema
 from app.schemas import StudentLoginSchema
 from app.schemas import StudentSchema
@@ -43,6 +66,11 @@ You can search, add, modify and delete student's accounts.
 tags_metadata = [
     {"name": "Courses", "description": "Endpoints to work with courses"},
     {"name": "Students", "description": "Endpoints to work with students"},
+    {
+        "name": "Deletion jobs",
+        "description": "Progress of course and account deletions",
+    },
+    {"name": "Service", "description": "Server health and load"},
 ]
 
 app = FastAPI(
@@ -62,6 +90,25 @@ app = FastAPI(
 )
 
 
+def idempotency_subject(authorization):
+    """The token's subject, so idempotency keys survive a token refresh"""
+    _, _, token = authorization.decode("latin-1").partition(" ")
+    try:
+        return auth_handler.decode_token(token).encode()
+    except HTTPException:
+        return authorization
+
+
+admission_controller = controller_from_env()
+app.add_middleware(
+    IdempotencyMiddleware,
+    store=store_from_env(),
+    identify=idempotency_subject,
+)
+# added last so it runs first and sheds before any other work
+app.add_middleware(AdmissionMiddleware, controller=admission_controller)
+
+
 # route handlers
 # Courses
 @app.get(
@@ -72,7 +119,7 @@ app = FastAPI(
 )
 async def get_all_courses():
     """A list of all courses"""
-    courses = db.query(Course).all()
+    courses = db.query(Course).filter(Course.deleted_at.is_(None)).all()
     return courses
 
 
@@ -84,7 +131,11 @@ async def get_all_courses():
 )
 async def get_single_course(id: int):
     """Find a course by ID"""
-    course = db.query(Course).filter(Course.course_id == id).first()
+    course = (
+        db.query(Course)
+        .filter(Course.course_id == id, Course.deleted_at.is_(None))
+        .first()
+    )
 
     if course is None:
         raise HTTPException(
@@ -93,6 +144,143 @@ async def get_single_course(id: int):
     return course
 
 
+@app.get(
+    "/api/v1/courses/{id}/related",
+    response_model=list[CourseSchema],
+    status_code=status.HTTP_200_OK,
+    tags=["Courses"],
+)
+async def get_related_courses(id: int):
+    """Courses most often taken by students of this course"""
+    course = (
+        db.query(Course)
+        .filter(Course.course_id == id, Course.deleted_at.is_(None))
+        .first()
+    )
+    if course is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail="Course not found"
+        )
+    related_ids = related_index.related(id)
+    courses = {
+        related.course_id: related
+        for related in db.query(Course).filter(
+            Course.course_id.in_(related_ids), Course.deleted_at.is_(None)
+        )
+    }
+    return [
+        courses[course_id] for course_id in related_ids if course_id in courses
+    ]
+
+
+@app.get(
+    "/api/v1/courses/{id}/sessions",
+    response_model=list[CourseSessionSchema],
+    status_code=status.HTTP_200_OK,
+    tags=["Courses"],
+)
+async def get_course_sessions(id: int):
+    """Weekly time slots of the course"""
+    course = (
+        db.query(Course)
+        .filter(Course.course_id == id, Course.deleted_at.is_(None))
+        .first()
+    )
+    if course is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail="Course not found"
+        )
+    sessions = (
+        db.query(CourseSession)
+        .filter(CourseSession.course_id == id)
+        .order_by(CourseSession.weekday, CourseSession.start_time)
+        .all()
+    )
+    return sessions
+
+
+@app.post(
+    "/api/v1/courses/{id}/sessions",
+    response_model=CourseSessionSchema,
+    status_code=status.HTTP_201_CREATED,
+    tags=["Courses"],
+)
+async def add_course_session(
+    id: int,
+    course_session: CourseSessionSchema,
+    credentials: HTTPAuthorizationCredentials = Security(security),
+):
+    """Add a weekly time slot to the course"""
+    token = credentials.credentials
+    if not auth_handler.decode_token(token):
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="You must authorize to change the course",
+        )
+    course = (
+        db.query(Course)
+        .filter(Course.course_id == id, Course.deleted_at.is_(None))
+        .first()
+    )
+    if course is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail="Course not found"
+        )
+    interval = session_interval(
+        course_session.weekday,
+        course_session.start_time,
+        course_session.end_time,
+    )
+    # the new slot must not overlap other courses of enrolled students
+    versions = lock_students(
+        db,
+        db.query(CourseSignUp.student_id).filter(CourseSignUp.course_id == id),
+    )
+    for student_id, version in versions.items():
+        conflicting_course_id = schedule_index.find_conflict(
+            db, student_id, version, [interval], ignore_course_id=id
+        )
+        if conflicting_course_id is not None:
+            db.rollback()
+            raise HTTPException(
+                status_code=400,
+                detail="The session conflicts with the course "
+                f"{conflicting_course_id} of the student {student_id}",
+            )
+    new_session = CourseSession(
+        course_id=id,
+        weekday=course_session.weekday,
+        start_time=course_session.start_time,
+        end_time=course_session.end_time,
+    )
+    db.add(new_session)
+    bump_schedule_versions(db, list(versions))
+    db.commit()
+    for student_id, version in versions.items():
+        schedule_index.add(student_id, version, id, [interval])
+    return new_session
+
+
+@app.post(
+    "/api/v1/courses/related/rebuild",
+    status_code=status.HTTP_202_ACCEPTED,
+    tags=["Courses"],
+)
+async def rebuild_related_courses(
+    background_tasks: BackgroundTasks,
+    credentials: HTTPAuthorizationCredentials = Security(security),
+):
+    """Rebuild the related courses index from all enrollments"""
+    token = credentials.credentials
+    if not auth_handler.decode_token(token):
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="You must authorize to rebuild the index",
+        )
+    background_tasks.add_task(related_index.rebuild)
+    return {"detail": "Rebuild started"}
+
+
 @app.post(
     "/api/v1/courses",
     status_code=status.HTTP_201_CREATED,
@@ -110,7 +298,11 @@ async def add_course(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="You must authorize to add the course",
         )
-    db_course = db.query(Course).filter(Course.title == course.title).first()
+    db_course = (
+        db.query(Course)
+        .filter(Course.title == course.title, Course.deleted_at.is_(None))
+        .first()
+    )
     if db_course is not None:
         raise HTTPException(
             status_code=400, detail="Course with the same title already exists"
@@ -145,7 +337,9 @@ async def update_the_course(
             detail="You must authorize to change the course",
         )
     updated_course = (
-        db.query(Course).filter(Course.course_id == course_id).first()
+        db.query(Course)
+        .filter(Course.course_id == course_id, Course.deleted_at.is_(None))
+        .first()
     )
     if updated_course is None:
         raise HTTPException(
@@ -166,6 +360,8 @@ async def update_the_course(
 )
 async def delete_the_course(
     course_id: int,
+    response: Response,
+    background_tasks: BackgroundTasks,
     credentials: HTTPAuthorizationCredentials = Security(security),
 ):
     token = credentials.credentials
@@ -175,14 +371,17 @@ async def delete_the_course(
             detail="You must authorize to delete the course",
         )
     course_to_delete = (
-        db.query(Course).filter(Course.course_id == course_id).first()
+        db.query(Course)
+        .filter(Course.course_id == course_id, Course.deleted_at.is_(None))
+        .first()
     )
     if course_to_delete is None:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND, detail="Course not found"
         )
-    db.delete(course_to_delete)
-    db.commit()
+    job = schedule_deletion(db, course_to_delete, "course")
+    background_tasks.add_task(purge, job.job_id)
+    response.headers["Location"] = f"/api/v1/deletion-jobs/{job.job_id}"
     return course_to_delete
 
 
@@ -194,7 +393,7 @@ async def delete_the_course(
 )
 async def get_all_students():
     """Show all students list"""
-    students = db.query(Student).all()
+    students = db.query(Student).filter(Student.deleted_at.is_(None)).all()
     return students
 
 
@@ -207,7 +406,9 @@ async def get_all_students():
 async def signup_student(student: StudentSchema):
     """Add a new user"""
     db_student = (
-        db.query(Student).filter(Student.email == student.email).first()
+        db.query(Student)
+        .filter(Student.email == student.email, Student.deleted_at.is_(None))
+        .first()
     )
 
     if db_student is not None:
@@ -215,7 +416,10 @@ async def signup_student(student: StudentSchema):
             status_code=400, detail="User with the same email already exists"
         )
 
-    hashed_password = auth_handler.encode_password(student.password)
+    # bcrypt is slow on purpose, keep it off the event loop
+    hashed_password = await run_in_threadpool(
+        auth_handler.encode_password, student.password
+    )
     new_student = Student(
         fullname=student.fullname,
         email=student.email,
@@ -235,11 +439,15 @@ async def signup_student(student: StudentSchema):
 async def student_login(student: StudentLoginSchema):
     """Login student"""
     student_db = (
-        db.query(Student).filter(Student.email == student.email).first()
+        db.query(Student)
+        .filter(Student.email == student.email, Student.deleted_at.is_(None))
+        .first()
     )
     if student_db is None:
         raise HTTPException(status_code=401, detail="Invalid login details!")
-    if not auth_handler.verify_password(student.password, student_db.password):
+    if not await run_in_threadpool(
+        auth_handler.verify_password, student.password, student_db.password
+    ):
         raise HTTPException(status_code=401, detail="Invalid login details!")
     access_token = auth_handler.encode_token(student.email)
     refresh_token = auth_handler.encode_refresh_token(student.email)
@@ -255,20 +463,27 @@ async def student_login(student: StudentLoginSchema):
 )
 async def delete_student_account(
     student_id: int,
+    response: Response,
+    background_tasks: BackgroundTasks,
     credentials: HTTPAuthorizationCredentials = Security(security),
 ):
     token = credentials.credentials
     if auth_handler.decode_token(token):
         account_to_delete = (
-            db.query(Student).filter(Student.student_id == student_id).first()
+            db.query(Student)
+            .filter(
+                Student.student_id == student_id, Student.deleted_at.is_(None)
+            )
+            .first()
         )
         if account_to_delete is None:
             raise HTTPException(
                 status_code=status.HTTP_404_NOT_FOUND,
                 detail="Student account not found",
             )
-        db.delete(account_to_delete)
-        db.commit()
+        job = schedule_deletion(db, account_to_delete, "student")
+        background_tasks.add_task(purge, job.job_id)
+        response.headers["Location"] = f"/api/v1/deletion-jobs/{job.job_id}"
         return account_to_delete
 
 
@@ -288,7 +503,10 @@ def signup_to_the_course(
         )
         check_student_id = (
             db.query(Student)
-            .filter(Student.student_id == payload.student_id)
+            .filter(
+                Student.student_id == payload.student_id,
+                Student.deleted_at.is_(None),
+            )
             .first()
         )
         if check_student_id is None:
@@ -298,7 +516,10 @@ def signup_to_the_course(
             )
         check_course_id = (
             db.query(Course)
-            .filter(Course.course_id == payload.course_id)
+            .filter(
+                Course.course_id == payload.course_id,
+                Course.deleted_at.is_(None),
+            )
             .first()
         )
         if check_course_id is None:
@@ -319,11 +540,80 @@ def signup_to_the_course(
                 status_code=400,
                 detail="You already have been signed up for the course",
             )
+        intervals = course_intervals(db, payload.course_id)
+        # the row lock serializes signups of the student across workers
+        version = lock_students(db, [payload.student_id]).get(
+            payload.student_id
+        )
+        if version is None:
+            db.rollback()
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail="Student not found",
+            )
+        conflicting_course_id = schedule_index.find_conflict(
+            db, payload.student_id, version, intervals
+        )
+        if conflicting_course_id is not None:
+            db.rollback()
+            raise HTTPException(
+                status_code=400,
+                detail="The course schedule conflicts with the course "
+                f"{conflicting_course_id}",
+            )
         db.add(new_signup)
+        bump_schedule_versions(db, [payload.student_id])
         db.commit()
+        schedule_index.add(
+            payload.student_id, version, payload.course_id, intervals
+        )
+        related_index.add_enrollment(
+            new_signup.course_sing_up_id,
+            payload.course_id,
+            lambda: other_signups(
+                db, payload.student_id, new_signup.course_sing_up_id
+            ),
+        )
         return new_signup
 
 
+@app.get(
+    "/api/v1/deletion-jobs/{job_id}",
+    response_model=DeletionJobSchema,
+    status_code=status.HTTP_200_OK,
+    tags=["Deletion jobs"],
+)
+async def get_deletion_job(job_id: int):
+    """Show the progress of a course or account deletion"""
+    job = db.query(DeletionJob).filter(DeletionJob.job_id == job_id).first()
+    if job is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail="Job not found"
+        )
+    db.refresh(job)
+    return job
+
+
+@app.get(
+    "/api/v1/admission",
+    status_code=status.HTTP_200_OK,
+    tags=["Service"],
+)
+async def get_admission_stats():
+    """Concurrency limits, queues and shed counters per route class"""
+    return admission_controller.stats()
+
+
+@app.on_event("startup")
+def resume_deletion_jobs():
+    threading.Thread(target=resume_unfinished, daemon=True).start()
+
+
+@app.on_event("startup")
+def build_related_index():
+    threading.Thread(target=related_index.rebuild, daemon=True).start()
+
+
 @app.exception_handler(RequestValidationError)
 async def validation_exception_handler(request, exc):
     return JSONResponse(
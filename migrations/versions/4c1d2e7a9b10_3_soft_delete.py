@@ -0,0 +1,53 @@
+"""3. soft delete
+
+Revision ID: 4c1d2e7a9b10
+Revises: ebb39c9ef0e2
+Create Date: 2022-08-20 12:00:00.000000
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = "4c1d2e7a9b10"
+down_revision = "ebb39c9ef0e2"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column(
+        "courses", sa.Column("deleted_at", sa.DateTime(), nullable=True)
+    )
+    op.add_column(
+        "students", sa.Column("deleted_at", sa.DateTime(), nullable=True)
+    )
+    op.create_table(
+        "deletion_jobs",
+        sa.Column("job_id", sa.Integer(), autoincrement=True, nullable=False),
+        sa.Column("entity", sa.String(), nullable=False),
+        sa.Column("entity_id", sa.Integer(), nullable=False),
+        sa.Column("status", sa.String(), nullable=False),
+        sa.Column("purged_signups", sa.Integer(), nullable=False),
+        sa.Column("error", sa.String(), nullable=True),
+        sa.Column("created_at", sa.DateTime(), nullable=False),
+        sa.Column("finished_at", sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint("job_id"),
+        sa.UniqueConstraint("job_id"),
+    )
+    # the purge job looks enrollments up by course and by student
+    op.create_index(
+        "ix_course_sign_up_course_id", "course_sign_up", ["course_id"]
+    )
+    op.create_index(
+        "ix_course_sign_up_student_id", "course_sign_up", ["student_id"]
+    )
+
+
+def downgrade() -> None:
+    op.drop_index("ix_course_sign_up_student_id", "course_sign_up")
+    op.drop_index("ix_course_sign_up_course_id", "course_sign_up")
+    op.drop_table("deletion_jobs")
+    op.drop_column("students", "deleted_at")
+    op.drop_column("courses", "deleted_at")
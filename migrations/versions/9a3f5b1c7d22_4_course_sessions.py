@@ -0,0 +1,43 @@
+"""4. course sessions
+
+Revision ID: 9a3f5b1c7d22
+Revises: 4c1d2e7a9b10
+Create Date: 2022-08-27 12:00:00.000000
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = "9a3f5b1c7d22"
+down_revision = "4c1d2e7a9b10"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "course_sessions",
+        sa.Column(
+            "session_id", sa.Integer(), autoincrement=True, nullable=False
+        ),
+        sa.Column("course_id", sa.Integer(), nullable=False),
+        sa.Column("weekday", sa.Integer(), nullable=False),
+        sa.Column("start_time", sa.Time(), nullable=False),
+        sa.Column("end_time", sa.Time(), nullable=False),
+        sa.ForeignKeyConstraint(
+            ["course_id"],
+            ["courses.course_id"],
+        ),
+        sa.PrimaryKeyConstraint("session_id"),
+        sa.UniqueConstraint("session_id"),
+    )
+    op.create_index(
+        "ix_course_sessions_course_id", "course_sessions", ["course_id"]
+    )
+
+
+def downgrade() -> None:
+    op.drop_index("ix_course_sessions_course_id", "course_sessions")
+    op.drop_table("course_sessions")
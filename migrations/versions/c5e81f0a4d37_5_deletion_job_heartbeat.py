@@ -0,0 +1,27 @@
+"""5. deletion job heartbeat
+
+Revision ID: c5e81f0a4d37
+Revises: 9a3f5b1c7d22
+Create Date: 2022-09-03 12:00:00.000000
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = "c5e81f0a4d37"
+down_revision = "9a3f5b1c7d22"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column(
+        "deletion_jobs",
+        sa.Column("heartbeat_at", sa.DateTime(), nullable=True),
+    )
+
+
+def downgrade() -> None:
+    op.drop_column("deletion_jobs", "heartbeat_at")
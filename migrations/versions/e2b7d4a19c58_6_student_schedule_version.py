@@ -0,0 +1,32 @@
+"""6. student schedule version
+
+Revision ID: e2b7d4a19c58
+Revises: c5e81f0a4d37
+Create Date: 2022-09-10 12:00:00.000000
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = "e2b7d4a19c58"
+down_revision = "c5e81f0a4d37"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column(
+        "students",
+        sa.Column(
+            "schedule_version",
+            sa.Integer(),
+            nullable=False,
+            server_default="0",
+        ),
+    )
+
+
+def downgrade() -> None:
+    op.drop_column("students", "schedule_version")